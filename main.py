@@ -1,7 +1,11 @@
 # app.py
 import os
+import re
+import sqlite3
+import threading
 import time
-from typing import Optional
+from collections import OrderedDict
+from typing import Callable, Optional
 
 import streamlit as st
 
@@ -12,6 +16,14 @@ try:
 except Exception:
     pass
 
+# --- diskcache is optional; without it replies are only cached in memory ---
+try:
+    from diskcache import Cache, Timeout as DiskCacheTimeout
+    DISK_CACHE_ERRORS = (OSError, sqlite3.Error, DiskCacheTimeout)
+except ImportError:
+    Cache = None
+    DISK_CACHE_ERRORS = (OSError, sqlite3.Error)
+
 # ================= Gemini config =================
 GEMINI_DEFAULT_MODEL = "gemini-1.5-flash"   # you can switch to "gemini-1.5-flash-8b" if you like
 
@@ -19,8 +31,17 @@ GEMINI_DEFAULT_MODEL = "gemini-1.5-flash"   # you can switch to "gemini-1.5-flas
 # If you want auto coaching lines after answers, set this True
 AI_COACH_ENABLED = False
 
-# Cooldown so the free tier (RPM limit) doesn't 429
-HINT_COOLDOWN_SEC = 30
+# Token bucket sized to the free-tier RPM limit so bursts are fine but we don't 429
+GEMINI_RPM = 15
+
+# Gemini replies: in-memory cache (L1); hint-button replies also go to an on-disk L2 that survives restarts
+HINT_CACHE_TTL_SEC = 24 * 60 * 60
+HINT_DISK_DIR = "./.hint_cache"
+HINT_DISK_LIMIT_BYTES = 10_000_000
+HINT_CACHE_MAX_ENTRIES = 64   # LRU cap for the in-memory L1 (ReplyStore)
+
+# Chat history cap per session (oldest messages are dropped)
+MAX_MESSAGES = 200
 
 # Built-in fallback hints (shown if Gemini throttles or isn't configured)
 PREWRITTEN_HINTS = {
@@ -28,81 +49,223 @@ PREWRITTEN_HINTS = {
     2: "Add audience, tone, and output format.",
     3: "Pick one short task and try it.",
 }
+DEFAULT_FALLBACK_HINT = "Keep it short and specific."
+
+# Hint prompt per module (0=welcome shares Module 1's prompt)
+_M1_HINT_PROMPT = "Give one short hint (<=20 words) to help a beginner name an everyday example of AI they use."
+HINT_PROMPTS = {
+    0: _M1_HINT_PROMPT,
+    1: _M1_HINT_PROMPT,
+    2: "Give one short hint (<=20 words) on improving a prompt with audience, tone, and output format.",
+    3: "Give one short hint (<=20 words) for choosing a quick hands-on AI exercise and completing it.",
+}
+DEFAULT_HINT_PROMPT = "Give a concise study hint (<=20 words) for learning basic AI concepts."
+
+class TokenBucket:
+    """Refills `rate` tokens/sec up to `capacity`; each Gemini request spends one."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def try_consume(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def drain(self, window_sec: float = 60):
+        # Go negative so the next token only comes back after a full quota window
+        self.tokens = 1 - self.rate * window_sec
+        self.updated = time.monotonic()
+
+@st.cache_resource(show_spinner=False)
+def _get_genai():
+    # Lazy, once per process: the SDK pulls in gRPC/protobuf, so only load it when a key
+    # is configured. Returns None if google-generativeai isn't installed.
+    try:
+        import google.generativeai as genai
+    except ImportError:
+        return None
+    return genai
 
-def configure_gemini():
-    import google.generativeai as genai
+@st.cache_resource(show_spinner=False)
+def _configure_gemini_once() -> dict:
+    # genai.configure is process-wide, so run it once rather than on every rerun
     api_key = st.secrets.get("GEMINI_API_KEY", os.getenv("GEMINI_API_KEY"))
-    if api_key:
-        try:
-            genai.configure(api_key=api_key)
-            st.session_state["gemini_ready"] = True
-        except Exception as e:
-            st.session_state["gemini_ready"] = False
-            st.session_state["gemini_error"] = str(e)
+    genai = _get_genai() if api_key else None
+    if genai is None:
+        return {"ready": False}
+    try:
+        genai.configure(api_key=api_key)
+    except Exception as e:
+        return {"ready": False, "error": str(e)}
+    return {"ready": True}
+
+def configure_gemini():
+    cfg = _configure_gemini_once()
+    st.session_state["gemini_ready"] = cfg["ready"]
+    if "error" in cfg:
+        st.session_state["gemini_error"] = cfg["error"]
+
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_model(model_name: str):
+    return _get_genai().GenerativeModel(model_name)
+
+
+@st.cache_resource(show_spinner=False)
+def get_hint_disk_cache():
+    # Best-effort L2: if the cache dir can't be opened, run with the in-memory cache only
+    if Cache is None:
+        return None
+    try:
+        return Cache(HINT_DISK_DIR, size_limit=HINT_DISK_LIMIT_BYTES, eviction_policy="least-recently-used")
+    except DISK_CACHE_ERRORS:
+        return None
+
+
+def _gemini_generate(model_name: str, prompt: str, temp: float, on_text: Optional[Callable[[str], None]] = None) -> str:
+    """Call Gemini; with `on_text`, stream and report the growing reply as chunks arrive.
+
+    Returns "" for an empty reply so callers can tell it apart from a real hint.
+    """
+    config = {"temperature": temp, "max_output_tokens": 200}
+    model = get_gemini_model(model_name)
+    if on_text is None:
+        text = model.generate_content(prompt, generation_config=config).text
     else:
-        st.session_state["gemini_ready"] = False
+        buf = []
+        for chunk in model.generate_content(prompt, generation_config=config, stream=True):
+            buf.append(chunk.text)
+            on_text("".join(buf))
+        text = "".join(buf)
+    return (text or "").strip()
+
+
+class ReplyStore:
+    """Thread-safe LRU of Gemini replies with a TTL, shared by every session in the process."""
+
+    def __init__(self, max_entries: int, ttl_sec: float):
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self._items = OrderedDict()   # key -> (stored_at, text)
+        self._lock = threading.Lock()
+
+    def get(self, key) -> Optional[str]:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            stored_at, text = item
+            if time.monotonic() - stored_at > self.ttl_sec:
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return text
+
+    def set(self, key, text: str):
+        with self._lock:
+            self._items[key] = (time.monotonic(), text)
+            self._items.move_to_end(key)
+            if len(self._items) > self.max_entries:
+                self._items.popitem(last=False)
+
+
+@st.cache_resource(show_spinner=False)
+def get_hint_memory_cache() -> ReplyStore:
+    return ReplyStore(HINT_CACHE_MAX_ENTRIES, HINT_CACHE_TTL_SEC)
+
+
+def _cached_reply(model_name: str, prompt: str, temp: float, persist: bool) -> Optional[str]:
+    key = (model_name, prompt, temp)
+    memory = get_hint_memory_cache()
+    text = memory.get(key)
+    if text is not None or not persist:
+        return text
+    disk = get_hint_disk_cache()
+    if disk is None:
+        return None
+    try:
+        text = disk.get(key)
+    except DISK_CACHE_ERRORS:
+        return None
+    if text is not None:
+        memory.set(key, text)
+    return text
+
 
+def _store_reply(model_name: str, prompt: str, temp: float, text: str, persist: bool):
+    # Only real hints: "(...)" strings are status/failure text (see the hint handler)
+    if not text or text.startswith("("):
+        return
+    key = (model_name, prompt, temp)
+    get_hint_memory_cache().set(key, text)
+    if not persist:
+        return
+    disk = get_hint_disk_cache()
+    if disk is not None:
+        try:
+            disk.set(key, text, expire=HINT_CACHE_TTL_SEC)
+        except DISK_CACHE_ERRORS:
+            pass  # already in memory; the disk copy is best-effort
 
-def gemini_reply(prompt: str, temp: float = 0.6, cache_key: Optional[str] = None) -> str:
-    """Call Gemini with a small per-session cache + cooldown + graceful 429 fallback."""
-    if "gemini_cache" not in st.session_state:
-        st.session_state.gemini_cache = {}
 
-    key = cache_key or prompt
-    if key in st.session_state.gemini_cache:
-        return st.session_state.gemini_cache[key]
+def gemini_reply(prompt: str, temp: float = 0.6, on_text: Optional[Callable[[str], None]] = None,
+                 shared: bool = True, persist: bool = False) -> str:
+    """Call Gemini via the global reply cache + token-bucket rate limit + graceful 429 fallback.
 
+    `on_text` enables streaming for cache misses; cached replies are returned without calling it.
+    `shared` uses the cross-session in-memory cache (turn off for prompts containing learner
+    text); `persist` also keeps the reply in the on-disk cache (fixed hint prompts only).
+    """
+    persist = persist and shared
     if not st.session_state.get("gemini_ready"):
         return "(Hint unavailable: Gemini key not configured.)"
 
-    # Cooldown
-    now = time.time()
-    next_ok = st.session_state.get("next_hint_ok_ts", 0)
-    if now < next_ok:
-        wait = int(next_ok - now)
-        return f"(Cooling down {wait}s to respect free-tier limits…)"
+    model_name = st.session_state.get("gemini_model", GEMINI_DEFAULT_MODEL)
+    text = _cached_reply(model_name, prompt, temp, persist) if shared else None
+    if text is not None:
+        return text
+
+    # Rate limit (per session)
+    bucket = st.session_state.setdefault("gemini_bucket", TokenBucket(GEMINI_RPM / 60, GEMINI_RPM))
+    if not bucket.try_consume():
+        return "(Free-tier limit reached; try again in a few seconds…)"
 
     try:
-        import google.generativeai as genai
-        model_name = st.session_state.get("gemini_model", GEMINI_DEFAULT_MODEL)
-        model = genai.GenerativeModel(model_name)
-        resp = model.generate_content(
-            prompt,
-            generation_config={"temperature": temp, "max_output_tokens": 200}
-        )
-        text = (resp.text or "").strip() or "(No response from Gemini.)"
-        st.session_state["next_hint_ok_ts"] = now + HINT_COOLDOWN_SEC
+        text = _gemini_generate(model_name, prompt, temp, on_text)
     except Exception as e:
         msg = str(e)
         if "429" in msg or "rate" in msg.lower():
-            st.session_state["next_hint_ok_ts"] = now + HINT_COOLDOWN_SEC
-            text = "(Free-tier limit hit; showing a built-in hint.)"
-        else:
-            text = f"(Gemini error: {e})"
-
-    st.session_state.gemini_cache[key] = text
+            bucket.drain()  # no further requests for the next minute
+            return "(Free-tier limit hit; showing a built-in hint.)"
+        return f"(Gemini error: {e})"
+    if not text:
+        return "(No response from Gemini.)"  # not cached, so the next click retries
+
+    if shared:
+        _store_reply(model_name, prompt, temp, text, persist)
     return text
 
 def current_hint_prompt() -> str:
-    m = st.session_state.module
-    if m in (0, 1):
-        return "Give one short hint (<=20 words) to help a beginner name an everyday example of AI they use."
-    if m == 2:
-        return "Give one short hint (<=20 words) on improving a prompt with audience, tone, and output format."
-    if m == 3:
-        return "Give one short hint (<=20 words) for choosing a quick hands-on AI exercise and completing it."
-    return "Give a concise study hint (<=20 words) for learning basic AI concepts."
+    return HINT_PROMPTS.get(st.session_state.module, DEFAULT_HINT_PROMPT)
 
 def fallback_hint_for_current_module() -> str:
-    m = max(1, min(3, st.session_state.module or 1))
-    return PREWRITTEN_HINTS.get(m, "Keep it short and specific.")
+    return PREWRITTEN_HINTS.get(st.session_state.module or 1, DEFAULT_FALLBACK_HINT)
 
 # ================= Streamlit app =================
 st.set_page_config(page_title="AI Starter Quest (Gemini Demo)", page_icon="🎓", layout="centered")
 
 def init_state():
     st.session_state.setdefault("progress", 0)           # 0..100
-    st.session_state.setdefault("badges", [])            # list[str]
+    st.session_state.setdefault("badges", [])            # list[str], display order
+    st.session_state.setdefault("_badge_set", set())     # same labels, for O(1) membership
     st.session_state.setdefault("module", 0)             # 0=welcome; 1..3 modules
     st.session_state.setdefault("messages", [])          # chat history
     st.session_state.setdefault("quiz_correct", 0)
@@ -120,7 +283,7 @@ if st.session_state.get("gemini_ready"):
 else:
     st.sidebar.info("Hints/coach optional. Add GEMINI_API_KEY in a .env to enable.")
 if st.sidebar.button("Reset demo"):
-    for k in ["progress","badges","module","messages","quiz_correct","email_captured","gemini_cache","next_hint_ok_ts"]:
+    for k in ["progress","badges","_badge_set","module","messages","quiz_correct","email_captured","gemini_bucket"]:
         st.session_state.pop(k, None)
     st.rerun()
 
@@ -130,22 +293,48 @@ with col1:
     st.title("🎓 AI Starter Quest")
     st.caption("Gamified learning + AI tutor (Gemini)")
 
-with col2:
-    st.write("**Progress**")
-    p = st.session_state.progress
-    st.progress(p/100 if p > 1 else p)
-    st.write("**Badges**")
-    st.write(" • ".join(st.session_state.badges) if st.session_state.badges else "_No badges yet_")
+# Progress/badges, chat history and the hint button are filled in at the end of the run,
+# after this run's chat input/hint click has been applied (so no extra st.rerun is needed)
+status_box = col2.container()
 
 st.divider()
+history_box = st.container()
+hint_box = st.container()
 
 # Helpers
 def say(role, text): st.chat_message(role).write(text)
-def badge(name, emoji):
-    label = f"{emoji} {name}"
-    if label not in st.session_state.badges:
+def render_status():
+    st.write("**Progress**")
+    p = st.session_state.progress
+    st.progress(p/100 if p > 1 else p)
+    st.write("**Badges**")
+    st.write(" • ".join(st.session_state.badges) if st.session_state.badges else "_No badges yet_")
+def history_line(m): return f"**You:** {m['content']}" if m["role"] == "user" else m["content"]
+def render_history(messages):
+    # Older turns go out as one markdown blob; only the latest turn gets chat bubbles
+    last_turn = next((i for i in range(len(messages) - 1, -1, -1) if messages[i]["role"] == "user"), 0)
+    if last_turn:
+        st.markdown("\n\n".join(history_line(m) for m in messages[:last_turn]))
+    for m in messages[last_turn:]:
+        say(m["role"], m["content"])
+def post(new_messages):
+    messages = st.session_state.messages
+    messages.extend(new_messages)
+    if len(messages) > MAX_MESSAGES:
+        del messages[:len(messages) - MAX_MESSAGES]
+# Renderers record progress/badges into a per-turn delta; route() applies it once
+def new_state_delta(): return {"progress": None, "badges_add": []}
+def badge(delta, name, emoji): delta["badges_add"].append(f"{emoji} {name}")
+def progress_to(delta, p): delta["progress"] = p if delta["progress"] is None else max(delta["progress"], p)
+def apply_state_delta(delta):
+    if delta["progress"] is not None:
+        st.session_state.progress = max(st.session_state.progress, delta["progress"])
+    badge_set = st.session_state._badge_set
+    for label in delta["badges_add"]:
+        if label in badge_set:
+            continue
+        badge_set.add(label)
         st.session_state.badges.append(label)
-def progress_to(p): st.session_state.progress = max(st.session_state.progress, p)
 
 # Seed message
 if not st.session_state.messages:
@@ -153,54 +342,54 @@ if not st.session_state.messages:
         {"role":"assistant","content":"Welcome! Type **begin** to start your AI journey. You'll complete 3 quick modules, earn badges, and preview your Report Card. Locked Level requires enrollment."}
     ]
 
-# Render history
-for m in st.session_state.messages:
-    say(m["role"], m["content"])
+# ---------- Modules ----------
+# Each renderer returns the assistant messages for this turn (coach lines first)
+def bot(text): return {"role":"assistant","content":text}
 
-# Hints: only after Module 1 begins
-if st.session_state.module >= 1 and st.button("💡 Get a hint"):
-    hint = gemini_reply(current_hint_prompt(), temp=0.7, cache_key=f"hint_m{st.session_state.module}")
-    if hint.startswith("("):  # throttled / not configured / cooling down
-        hint = fallback_hint_for_current_module() + " " + hint
-    st.session_state.messages.append({"role":"assistant","content": f"**Hint:** {hint}"})
-    st.rerun()
+# Report card ratings by quiz_correct (0..2: one quiz each in Modules 1 and 2)
+CONCEPTS_STARS = {0: "★★★☆☆", 1: "★★★★☆", 2: "★★★★★"}
+PROMPT_STARS = {0: "★★☆☆☆", 1: "★★★☆☆", 2: "★★★★☆"}
 
-# ---------- Modules ----------
-def render_module_1(user_text: str):
-    txt = user_text.strip().lower()
+GREETINGS = frozenset({"hi","hello","hey","yo","hola","help","start"})
+# Substring match (no word boundaries) so e.g. "recommendations" still counts
+_M1_KEYWORDS = re.compile(r"netflix|spotify|recommend|maps|autocorrect|autocomplete|youtube")
 
+def render_module_1(delta: dict, s: str, lo: str, up: str):
     # Friendly greetings before start
-    if txt in {"hi","hello","hey","yo","hola","help","start"}:
-        return "Hi! 👋 Type **begin** to start Module 1."
-
-    if txt == "begin":
-        progress_to(20); badge("Concept Spark", "🏅")
-        return ("### Module 1: What is AI?\n"
-                "AI helps computers perform tasks like pattern recognition, prediction, and content generation.\n\n"
-                "**Checkpoint:** Name one everyday example of AI you've used or seen.")
-    elif any(k in txt for k in ["netflix","spotify","recommend","maps","autocorrect","autocomplete","youtube"]):
-        progress_to(40)
+    if lo in GREETINGS:
+        return [bot("Hi! 👋 Type **begin** to start Module 1.")]
+
+    if lo == "begin":
+        progress_to(delta, 20); badge(delta, "Concept Spark", "🏅")
+        return [bot("### Module 1: What is AI?\n"
+                    "AI helps computers perform tasks like pattern recognition, prediction, and content generation.\n\n"
+                    "**Checkpoint:** Name one everyday example of AI you've used or seen.")]
+    elif _M1_KEYWORDS.search(lo):
+        progress_to(delta, 40)
+        out = []
         if AI_COACH_ENABLED and st.session_state.get("gemini_ready"):
             coach = gemini_reply(
                 "Explain in one friendly sentence why recommendations (e.g., Netflix) are an example of AI, for a non-technical learner.",
                 temp=0.4
             )
-            st.session_state.messages.append({"role":"assistant","content": f"**Tutor:** {coach}"})
-        return ("Nice! ✅ Recommendation engines (like Netflix/Spotify) are classic AI.\n\n"
-                "**Mini-Quiz:** Which statement is MOST accurate?\n"
-                "A) AI is one algorithm.\n"
-                "B) AI is a field with many methods, such as machine learning.\n"
-                "C) AI is magic.\n\n"
-                "_Reply with A, B, or C._")
-    elif txt.upper() in ["A","B","C"]:
-        if txt.upper() == "B":
+            out.append(bot(f"**Tutor:** {coach}"))
+        out.append(bot("Nice! ✅ Recommendation engines (like Netflix/Spotify) are classic AI.\n\n"
+                       "**Mini-Quiz:** Which statement is MOST accurate?\n"
+                       "A) AI is one algorithm.\n"
+                       "B) AI is a field with many methods, such as machine learning.\n"
+                       "C) AI is magic.\n\n"
+                       "_Reply with A, B, or C._"))
+        return out
+    elif up in ["A","B","C"]:
+        out = []
+        if up == "B":
             st.session_state.quiz_correct += 1
             if AI_COACH_ENABLED and st.session_state.get("gemini_ready"):
                 fb = gemini_reply(
                     "In one sentence, praise a learner for selecting option B (AI is a field) and add a tiny follow-up tip.",
                     temp=0.3
                 )
-                st.session_state.messages.append({"role":"assistant","content": f"**Tutor:** {fb}"})
+                out.append(bot(f"**Tutor:** {fb}"))
             msg = "Correct! 🎉"
         else:
             if AI_COACH_ENABLED and st.session_state.get("gemini_ready"):
@@ -208,56 +397,59 @@ def render_module_1(user_text: str):
                     "In one sentence, gently correct a learner who picked A or C and say why B is best, in plain English.",
                     temp=0.3
                 )
-                st.session_state.messages.append({"role":"assistant","content": f"**Tutor:** {tip}"})
+                out.append(bot(f"**Tutor:** {tip}"))
             msg = "Good try — the best answer is **B**."
-        progress_to(50); st.session_state.module = 2
-        return msg + "\n\n**Progress saved.** Moving to **Module 2: Prompting Basics**.\nType anything to continue."
+        progress_to(delta, 50); st.session_state.module = 2
+        out.append(bot(msg + "\n\n**Progress saved.** Moving to **Module 2: Prompting Basics**.\nType anything to continue."))
+        return out
     else:
-        return "Type **begin** to start the course, or say something like `Netflix recommendations` for the checkpoint."
+        return [bot("Type **begin** to start the course, or say something like `Netflix recommendations` for the checkpoint.")]
 
-def render_module_2(user_text: str):
+def render_module_2(delta: dict, s: str, lo: str, up: str):
     if st.session_state.progress < 60:
-        progress_to(60); badge("Prompt Explorer", "🔎")
-        return ("### Module 2: Prompting Basics\n"
-                "Good prompts are **clear**, **contextual**, and **goal-oriented**.\n\n"
-                "**Task:** Rewrite this weak prompt to be specific.\n"
-                "_Weak_: `Write marketing ideas.`\n"
-                "Include audience, tone, and format.")
+        progress_to(delta, 60); badge(delta, "Prompt Explorer", "🔎")
+        return [bot("### Module 2: Prompting Basics\n"
+                    "Good prompts are **clear**, **contextual**, and **goal-oriented**.\n\n"
+                    "**Task:** Rewrite this weak prompt to be specific.\n"
+                    "_Weak_: `Write marketing ideas.`\n"
+                    "Include audience, tone, and format.")]
     else:
-        attempt = user_text.strip()
-        if attempt and attempt.upper() not in ["A","B"]:
+        attempt = s
+        if attempt and up not in ["A","B"]:
+            out = []
             if AI_COACH_ENABLED and st.session_state.get("gemini_ready"):
                 rubric = f"Rate this prompt for clarity, context, and format (1-5 each) and give one improvement tip in <=30 words:\n\n{attempt}"
-                review = gemini_reply(rubric, temp=0.3)
-                st.session_state.messages.append({"role":"assistant","content": f"**Tutor review:** {review}"})
-            progress_to(80)
-            return ("**Quick Check:** Which prompt yields structured output?\n"
-                    "A) `Write about AI.`\n"
-                    "B) `Create a 5-step checklist for starting with AI at a small bakery, numbered list.`\n\n"
-                    "_Reply with A or B._")
-        elif attempt.upper() in ["A","B"]:
-            if attempt.upper() == "B":
+                review = gemini_reply(rubric, temp=0.3, shared=False)  # embeds the learner's prompt
+                out.append(bot(f"**Tutor review:** {review}"))
+            progress_to(delta, 80)
+            out.append(bot("**Quick Check:** Which prompt yields structured output?\n"
+                           "A) `Write about AI.`\n"
+                           "B) `Create a 5-step checklist for starting with AI at a small bakery, numbered list.`\n\n"
+                           "_Reply with A or B._"))
+            return out
+        elif up in ["A","B"]:
+            if up == "B":
                 st.session_state.quiz_correct += 1
-                st.session_state.messages.append({"role":"assistant","content":"**Tutor:** Great pick — numbered steps create structure."})
+                coach = bot("**Tutor:** Great pick — numbered steps create structure.")
             else:
-                st.session_state.messages.append({"role":"assistant","content":"**Tutor:** Close. Asking for numbered steps (B) yields a tidy result."})
-            st.session_state.module = 3; progress_to(85)
-            return "Moving to **Module 3: Hands-On**. Type anything to continue."
+                coach = bot("**Tutor:** Close. Asking for numbered steps (B) yields a tidy result.")
+            st.session_state.module = 3; progress_to(delta, 85)
+            return [coach, bot("Moving to **Module 3: Hands-On**. Type anything to continue.")]
         else:
-            return "Try adding audience, tone, and format (e.g., Instagram posts, friendly tone, bullet list)."
+            return [bot("Try adding audience, tone, and format (e.g., Instagram posts, friendly tone, bullet list).")]
 
-def render_module_3(user_text: str):
+def render_module_3(delta: dict, s: str, lo: str, up: str):
     if st.session_state.progress < 90:
-        progress_to(90); badge("AI Tinkerer", "🛠️")
-        return ("### Module 3: Hands-On Practice\n"
-                "Pick a quick exercise (reply with 1, 2, or 3):\n"
-                "1) Content — 5 product ideas using AI\n"
-                "2) Customer Support — empathetic reply to a delay complaint\n"
-                "3) Data — 3 ways AI can save time in spreadsheets")
+        progress_to(delta, 90); badge(delta, "AI Tinkerer", "🛠️")
+        return [bot("### Module 3: Hands-On Practice\n"
+                    "Pick a quick exercise (reply with 1, 2, or 3):\n"
+                    "1) Content — 5 product ideas using AI\n"
+                    "2) Customer Support — empathetic reply to a delay complaint\n"
+                    "3) Data — 3 ways AI can save time in spreadsheets")]
     else:
-        choice = user_text.strip()
+        choice = s
         if choice in ["1","2","3"]:
-            progress_to(95)
+            progress_to(delta, 95)
             prompts = {
                 "1": "Generate 5 product ideas for eco-friendly kitchen tools.",
                 "2": "Write a brief, empathetic apology for a delayed order; offer options to resolve.",
@@ -267,44 +459,67 @@ def render_module_3(user_text: str):
             if st.session_state.get("gemini_ready") and AI_COACH_ENABLED:
                 hint_text = gemini_reply(f"Give one 15-word tip to do this well: {prompts[choice]}", temp=0.6)
                 hint = f"\n\n**Tutor tip:** {hint_text}"
-            return f"Great choice! Try this: **{prompts[choice]}**{hint}\n\n_When you're done, type `done`._"
-        elif choice.lower() == "done":
-            progress_to(100)
-            return (
+            return [bot(f"Great choice! Try this: **{prompts[choice]}**{hint}\n\n_When you're done, type `done`._")]
+        elif lo == "done":
+            progress_to(delta, 100)
+            return [bot(
                 "👏 Nicely done. You've completed the free track!\n\n"
                 "## 🔒 Locked Level: Applied AI Playbooks\n"
                 "- 12 advanced prompt frameworks\n- Case studies + templates\n- Certificate + full Report Card\n\n"
                 "👉 **Unlock via the AI Learning Academy:** [Enroll to unlock](https://example.com/enroll)\n\n"
                 "### Report Card (Preview)\n"
-                f"- Concepts: {'★'*min(5,3 + st.session_state.quiz_correct)}{'☆'*max(0,5-(3+st.session_state.quiz_correct))}\n"
-                f"- Prompt Craft: {'★'*min(5,2 + st.session_state.quiz_correct)}{'☆'*max(0,5-(2+st.session_state.quiz_correct))}\n"
+                f"- Concepts: {CONCEPTS_STARS[min(2, st.session_state.quiz_correct)]}\n"
+                f"- Prompt Craft: {PROMPT_STARS[min(2, st.session_state.quiz_correct)]}\n"
                 "- Applied Practice: ★★★☆☆\n"
                 "- Consistency: ★★☆☆☆\n\n"
                 "_Enter your email to receive your badges + preview report & a limited-time coupon._"
-            )
+            )]
         else:
-            return "Reply with `1`, `2`, or `3` to pick an exercise, then type `done` when finished."
+            return [bot("Reply with `1`, `2`, or `3` to pick an exercise, then type `done` when finished.")]
 
 def route(user_text: str):
+    # Normalize once per turn; renderers share the results
+    s = user_text.strip(); lo = s.lower(); up = s.upper()
+    delta = new_state_delta()
+    kw = dict(delta=delta, s=s, lo=lo, up=up)
     m = st.session_state.module
     if m == 0:
         st.session_state.module = 1
-        return render_module_1(user_text)
-    if m == 1:
-        return render_module_1(user_text)
-    if m == 2:
-        return render_module_2(user_text)
-    if m == 3:
-        return render_module_3(user_text)
-    return "Say **begin** to start."
+        out = render_module_1(**kw)
+    elif m == 1:
+        out = render_module_1(**kw)
+    elif m == 2:
+        out = render_module_2(**kw)
+    elif m == 3:
+        out = render_module_3(**kw)
+    else:
+        out = [bot("Say **begin** to start.")]
+    apply_state_delta(delta)
+    return out
 
 # Chat input
 user_input = st.chat_input("Your answer...")
 if user_input:
-    st.session_state.messages.append({"role":"user","content":user_input})
-    reply = route(user_input)
-    st.session_state.messages.append({"role":"assistant","content": reply})
-    st.rerun()
+    turn = [{"role":"user","content":user_input}] + route(user_input)
+    post(turn)
+
+# Hints: only after Module 1 begins
+with hint_box:
+    if st.session_state.module >= 1 and st.button("💡 Get a hint"):
+        live = st.empty()  # streamed hint text; the final hint is posted to the chat below
+        with st.spinner("Thinking..."):
+            hint = gemini_reply(current_hint_prompt(), temp=0.7, persist=True,
+                                on_text=lambda t: live.markdown(f"**Hint:** {t}"))
+        live.empty()
+        if hint.startswith("("):  # throttled / not configured / rate limited
+            hint = fallback_hint_for_current_module() + " " + hint
+        post([{"role":"assistant","content": f"**Hint:** {hint}"}])
+
+# Render history + status with everything applied this run
+with history_box:
+    render_history(st.session_state.messages)
+with status_box:
+    render_status()
 
 # Email capture
 st.divider()
@@ -317,4 +532,4 @@ with st.expander("Enrollment & Email (Demo)"):
         else:
             st.error("Please enter a valid email.")
 
-st.caption("Demo shows: progress, badges, quizzes, (optional) AI hints via Gemini with cooldown, locked level, upsell CTA, report card preview.")
+st.caption("Demo shows: progress, badges, quizzes, (optional) AI hints via Gemini with rate limiting, locked level, upsell CTA, report card preview.")